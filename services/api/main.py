@@ -3,15 +3,26 @@ from fastapi import FastAPI, Query
 import httpx
 from fastapi.middleware.cors import CORSMiddleware
 import base64
+import contextlib
+import functools
 from urllib.parse import unquote
 import asyncio
 import os
-import json
+import ijson
+import orjson
+import xxhash
+import zstandard as zstd
 import time
-import hashlib
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Any, Dict, Optional
+from typing import Any, Callable, Dict, Optional, Tuple
 
+# Pure and called per result row; popular DBpedia URIs recur across endpoints.
+# (id_to_uri isn't memoized: it runs once per request on a client-controlled id.)
+@functools.lru_cache(maxsize=65536)
 def uri_to_id(uri: str) -> str:
     return base64.urlsafe_b64encode(uri.encode("utf-8")).decode("ascii").rstrip("=")
 
@@ -36,216 +47,728 @@ app.add_middleware(
 
 
 DBPEDIA_SPARQL = "https://dbpedia.org/sparql"
+# STRSTARTS on this prefix can use DBpedia's IRI index; CONTAINS can't
+DBPEDIA_CATEGORY_PREFIX = "http://dbpedia.org/resource/Category:"
 
 from fastapi import HTTPException
 from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
 
+# safest minimal escaping for SPARQL string literal in double quotes
+_SPARQL_STR_ESC = str.maketrans({
+    "\\": "\\\\",
+    '"': '\\"',
+    "\n": " ",
+    "\r": " ",
+})
+
 def sparql_escape_str(s: str) -> str:
-    # safest minimal escaping for SPARQL string literal in double quotes
-    return (
-        s.replace("\\", "\\\\")
-         .replace('"', '\\"')
-         .replace("\n", " ")
-         .replace("\r", " ")
-    )
+    # single pass instead of one .replace() per character class
+    return s.translate(_SPARQL_STR_ESC)
 
 # ---------------------------
-# Simple persistent disk cache (JSON) with TTL
+# Simple persistent disk cache (zstd-compressed JSON) with TTL
 # ---------------------------
 
 CACHE_TTL_SECONDS = int(os.getenv("WADE_CACHE_TTL_SECONDS", str(12 * 60 * 60)))  # 12 hours
 CACHE_DIR = Path(os.getenv("WADE_CACHE_DIR", ".wade_cache"))
 CACHE_DIR.mkdir(parents=True, exist_ok=True)
+CACHE_ZSTD_LEVEL = int(os.getenv("WADE_CACHE_ZSTD_LEVEL", "6"))
+CACHE_SWEEP_INTERVAL_SECONDS = int(os.getenv("WADE_CACHE_SWEEP_SECONDS", str(10 * 60)))  # 10 minutes
 
-_cache_lock = asyncio.Lock()
 _inflight = {}  # type: Dict[str, asyncio.Task]
 
+# Cache file I/O runs off the event loop on a small dedicated pool
+_cache_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="wade-cache")
+
+# In-process L1 in front of the disk cache: key -> (expires_at, value).
+# Only touched from the event loop thread, so no lock is needed.
+MEM_CACHE_MAX = int(os.getenv("WADE_MEM_CACHE_MAX", "1024"))
+_mem_cache = OrderedDict()  # type: OrderedDict[str, Tuple[float, Any]]
+
+def _mem_cache_put(key: str, expires_at: float, value: Any) -> None:
+    _mem_cache[key] = (expires_at, value)
+    _mem_cache.move_to_end(key)
+    while len(_mem_cache) > MEM_CACHE_MAX:
+        _mem_cache.popitem(last=False)
+
+# String literals and IRIs are copied verbatim; everything else is canonicalized.
+_SPARQL_TOKEN_RE = re.compile(
+    r"""
+    (?P<verbatim>
+        \"\"\"(?:[^"\\]|\\.|"(?!""))*\"\"\"
+      | '''(?:[^'\\]|\\.|'(?!''))*'''
+      | "(?:[^"\\\n]|\\.)*"
+      | '(?:[^'\\\n]|\\.)*'
+      | <[^<>"{}|^`\\\s]*>
+    )
+  | (?P<ws>(?:\s|\#[^\n]*)+)
+  | (?P<kw>(?<![?$:@.\w-])(?:
+        select|distinct|reduced|construct|describe|ask|from|named|where
+      | optional|union|minus|graph|service|bind|values|filter|not|exists|in|as
+      | group|by|having|order|asc|desc|limit|offset|prefix|base
+    )(?![\w:-]))
+    """,
+    re.IGNORECASE | re.VERBOSE,
+)
+
+_SPARQL_PREFIX_RE = re.compile(r"PREFIX ?([A-Za-z][\w.-]*)?: ?(<[^<>\s]*>) ?")
+
+def _canonical_token(m: "re.Match[str]") -> str:
+    if m.lastgroup == "ws":
+        return " "
+    if m.lastgroup == "kw":
+        return m.group().upper()
+    return m.group()
+
 def _normalize_sparql(q: str) -> str:
-    # Make formatting differences less likely to miss the cache
-    return " ".join(q.split())
+    # Make formatting differences less likely to miss the cache:
+    # drop comments, collapse whitespace, uppercase keywords, sort PREFIXes.
+    # Literals, IRIs and variable names are left untouched.
+    text = _SPARQL_TOKEN_RE.sub(_canonical_token, q).strip()
+
+    prefixes = []
+    pos = 0
+    while True:
+        m = _SPARQL_PREFIX_RE.match(text, pos)
+        if m is None:
+            break
+        prefixes.append((m.group(1) or "", m.group(2)))
+        pos = m.end()
+
+    names = [name for name, _ in prefixes]
+    if len(set(names)) != len(names):
+        # a redefined prefix makes declaration order significant
+        return text
+    head = " ".join(f"PREFIX {name}: {iri}" for name, iri in sorted(prefixes))
+    body = text[pos:]
+    return f"{head} {body}" if head and body else head or body
 
 def _cache_key(query: str) -> str:
-    h = hashlib.sha256()
+    # non-cryptographic is fine for a local cache key; 128 bits keeps collisions negligible
+    h = xxhash.xxh3_128()
     h.update(DBPEDIA_SPARQL.encode("utf-8"))
     h.update(b"\n")
     h.update(_normalize_sparql(query).encode("utf-8"))
     return h.hexdigest()
 
 def _cache_path(key: str) -> Path:
-    # store each entry as one JSON file
-    return CACHE_DIR / f"{key}.json"
+    # store each entry as one zstd-compressed JSON file, sharded by the first
+    # two hex chars (like git objects) so no directory grows unbounded
+    return CACHE_DIR / key[:2] / f"{key[2:]}.json.zst"
+
+def _migrate_flat_cache() -> None:
+    # one-time move of entries written before sharding (CACHE_DIR/<key>.json.zst);
+    # pre-zstd <key>.json files can't be read anymore, so drop them
+    for path in CACHE_DIR.glob("*.json*"):
+        try:
+            if path.name.endswith(".json.zst"):
+                target = _cache_path(path.name[: -len(".json.zst")])
+                target.parent.mkdir(parents=True, exist_ok=True)
+                path.replace(target)
+            elif path.suffix == ".json":
+                path.unlink()
+        except Exception:
+            pass
+
+# zstd contexts aren't safe for concurrent use, so each cache I/O thread gets its own
+_zstd_local = threading.local()
+
+def _zstd_contexts() -> Tuple[zstd.ZstdCompressor, zstd.ZstdDecompressor]:
+    ctx = getattr(_zstd_local, "ctx", None)
+    if ctx is None:
+        ctx = _zstd_local.ctx = (zstd.ZstdCompressor(level=CACHE_ZSTD_LEVEL), zstd.ZstdDecompressor())
+    return ctx
 
 def _read_cache_file(path: Path) -> Dict[str, Any]:
-    with path.open("r", encoding="utf-8") as f:
-        return json.load(f)
+    _, dctx = _zstd_contexts()
+    return orjson.loads(dctx.decompress(path.read_bytes()))
 
 def _write_cache_file_atomic(path: Path, payload: Dict[str, Any]) -> None:
-    tmp = path.with_suffix(".tmp")
-    with tmp.open("w", encoding="utf-8") as f:
-        json.dump(payload, f, ensure_ascii=False)
+    cctx, _ = _zstd_contexts()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # unique per writer, so concurrent writes of the same key don't share a temp
+    # file; leftovers from a crash still end in .tmp and get swept
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    tmp.write_bytes(cctx.compress(orjson.dumps(payload)))
     tmp.replace(path)
 
-async def cache_get(key: str) -> Optional[Dict[str, Any]]:
-    path = _cache_path(key)
+def _mem_cache_get(key: str) -> Optional[Dict[str, Any]]:
+    hit = _mem_cache.get(key)
+    if hit is None:
+        return None
+    if hit[0] <= time.time():
+        del _mem_cache[key]
+        return None
+    _mem_cache.move_to_end(key)
+    return hit[1]
+
+def _load_cache_entry(path: Path) -> Optional[Tuple[float, Any]]:
+    # runs on _cache_executor; returns (expires_at, value) or None
     if not path.exists():
         return None
+    # stale or corrupted entries are just a miss here; the sweeper deletes
+    # expired files and the next cache_set overwrites corrupted ones
     try:
         obj = _read_cache_file(path)
         expires_at = float(obj.get("expires_at", 0))
         if expires_at <= time.time():
-            # expired
-            try:
-                path.unlink()
-            except Exception:
-                pass
             return None
-        return obj.get("value")
+        return expires_at, obj.get("value")
     except Exception:
-        # corrupted cache entry -> delete it
+        return None
+
+def _sweep_expired_entries() -> None:
+    # entries are written once at creation, so mtime + TTL is their expiry;
+    # this avoids decompressing every file just to read expires_at
+    cutoff = time.time() - CACHE_TTL_SECONDS
+    for path in CACHE_DIR.rglob("*"):
+        if not (path.name.endswith(".json.zst") or path.suffix == ".tmp"):
+            continue
+        try:
+            if path.stat().st_mtime <= cutoff:
+                path.unlink()
+        except Exception:
+            pass
+
+async def _sweep_cache_forever() -> None:
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(CACHE_SWEEP_INTERVAL_SECONDS)
         try:
-            path.unlink()
+            await loop.run_in_executor(_cache_executor, _sweep_expired_entries)
         except Exception:
             pass
+
+_sweep_task = None  # type: Optional[asyncio.Task]
+
+@app.on_event("startup")
+async def _start_cache_maintenance() -> None:
+    global _sweep_task
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(_cache_executor, _migrate_flat_cache)
+    _sweep_task = asyncio.create_task(_sweep_cache_forever())
+
+@app.on_event("shutdown")
+async def _stop_cache_sweeper() -> None:
+    if _sweep_task is not None:
+        _sweep_task.cancel()
+
+async def cache_get(key: str) -> Optional[Dict[str, Any]]:
+    hit = _mem_cache_get(key)
+    if hit is not None:
+        return hit
+
+    loop = asyncio.get_running_loop()
+    entry = await loop.run_in_executor(_cache_executor, _load_cache_entry, _cache_path(key))
+    if entry is None:
         return None
+    expires_at, value = entry
+    _mem_cache_put(key, expires_at, value)
+    return value
 
 async def cache_set(key: str, value: Dict[str, Any]) -> None:
     path = _cache_path(key)
+    now = time.time()
     payload = {
-        "created_at": time.time(),
-        "expires_at": time.time() + CACHE_TTL_SECONDS,
+        "created_at": now,
+        "expires_at": now + CACHE_TTL_SECONDS,
         "value": value,
     }
+    _mem_cache_put(key, payload["expires_at"], value)
+    loop = asyncio.get_running_loop()
     try:
-        _write_cache_file_atomic(path, payload)
+        await loop.run_in_executor(_cache_executor, _write_cache_file_atomic, path, payload)
     except Exception:
         # caching is best-effort; never break API calls because cache failed
         pass
 
 
-@retry(
+# ---------------------------
+# Shared HTTP/2 client (one connection pool for all DBpedia calls)
+# ---------------------------
+
+_http_client = None  # type: Optional[httpx.AsyncClient]
+
+def _get_http_client() -> httpx.AsyncClient:
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            # concurrent DBpedia requests multiplex over one TCP+TLS connection
+            http2=True,
+            timeout=httpx.Timeout(connect=10.0, read=60.0, write=10.0, pool=10.0),
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+        )
+    return _http_client
+
+async def _close_http_client() -> None:
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+
+_SPARQL_RESULTS_FORMAT = "application/sparql-results+json"
+_SPARQL_HEADERS = {
+    "Accept": "application/sparql-results+json",
+    # httpx decodes these transparently (br needs the brotli package)
+    "Accept-Encoding": "gzip, deflate, br",
+}
+
+# Retries transient transport failures. Applied to the raw DBpedia request inside
+# _sparql_errors, so it sees httpx exceptions before they become HTTPException.
+_sparql_retry = retry(
     reraise=True,
     stop=stop_after_attempt(3),
     wait=wait_exponential(multiplier=0.5, min=0.5, max=4),
     retry=retry_if_exception_type((httpx.ReadTimeout, httpx.ConnectTimeout, httpx.RemoteProtocolError)),
 )
-async def run_sparql(query: str) -> Dict[str, Any]:
-    key = _cache_key(query)
-
-    # 1) Cache hit
-    cached = await cache_get(key)
-    if cached is not None:
-        return cached
 
-    async def _do_fetch() -> Dict[str, Any]:
-        # NOTE: query must be closed over; key computed outside
-        params = {"query": query, "format": "application/sparql-results+json"}
-        timeout = httpx.Timeout(connect=10.0, read=60.0, write=10.0, pool=10.0)
+@contextlib.contextmanager
+def _sparql_errors():
+    # map transport failures to the HTTP errors the API exposes
+    try:
+        yield
+    except httpx.TimeoutException as e:
+        raise HTTPException(status_code=504, detail="SPARQL endpoint timed out") from e
+    except httpx.HTTPStatusError as e:
+        raise HTTPException(status_code=502, detail=f"SPARQL endpoint error: {e.response.status_code}") from e
+    except httpx.HTTPError as e:
+        raise HTTPException(status_code=502, detail="SPARQL request failed") from e
+
+class _AsyncByteReader:
+    # minimal async file-like over an httpx byte stream, as ijson expects
+    def __init__(self, chunks):
+        self._chunks = chunks.__aiter__()
+
+    async def read(self, n: int = -1) -> bytes:
+        if n == 0:
+            # ijson probes with read(0) to detect bytes vs str
+            return b""
+        try:
+            return await self._chunks.__anext__()
+        except StopAsyncIteration:
+            return b""
 
-        async with httpx.AsyncClient(timeout=timeout) as client:
-            try:
-                r = await client.get(
-                    DBPEDIA_SPARQL,
-                    params=params,
-                    headers={"Accept": "application/sparql-results+json"},
-                )
-                r.raise_for_status()
-                data = r.json()
-
-                # cache successful responses
-                await cache_set(key, data)
-                return data
-
-            except httpx.TimeoutException as e:
-                raise HTTPException(status_code=504, detail="SPARQL endpoint timed out") from e
-            except httpx.HTTPStatusError as e:
-                raise HTTPException(status_code=502, detail=f"SPARQL endpoint error: {e.response.status_code}") from e
-            except httpx.HTTPError as e:
-                raise HTTPException(status_code=502, detail="SPARQL request failed") from e
-
-    # 2) Single-flight: reuse in-flight task
-    async with _cache_lock:
-        # re-check cache inside lock (avoid thundering herd)
-        cached2 = await cache_get(key)
-        if cached2 is not None:
-            return cached2
-
-        task = _inflight.get(key)
-        if task is None:
-            task = asyncio.create_task(_do_fetch())
-            _inflight[key] = task
+# cache=False keeps single-flight but skips the memory and disk caches. Used by
+# @_result_cache endpoints, whose shaped response is already cached one layer up.
+async def _cached_single_flight(key: str, fetch, cache: bool = True) -> Any:
+    # 1) Cache hit
+    if cache:
+        cached = await cache_get(key)
+        if cached is not None:
+            return cached
+
+    async def _do_fetch() -> Any:
+        data = await fetch()
+        if cache:
+            # cache successful responses
+            await cache_set(key, data)
+        return data
+
+    # 2) Single-flight: reuse in-flight task.
+    # No lock needed: there is no await between the lookup and the insert,
+    # so this check-and-set is atomic on the event loop.
+    task = _inflight.get(key)
+    if task is None:
+        if cache:
+            # a fetch may have completed while we awaited the disk read; cache_set
+            # fills L1 before that fetch's task finishes, so checking L1 suffices.
+            # (cache=False never awaits before this point, so it has no such window.)
+            cached2 = _mem_cache_get(key)
+            if cached2 is not None:
+                return cached2
+        task = asyncio.create_task(_do_fetch())
+        _inflight[key] = task
 
     try:
         return await task
     finally:
         # Only remove if we're removing the same task instance
-        async with _cache_lock:
-            if _inflight.get(key) is task:
-                _inflight.pop(key, None)
+        if _inflight.get(key) is task:
+            _inflight.pop(key, None)
+
+
+async def run_sparql(query: str, cache: bool = True) -> Dict[str, Any]:
+    @_sparql_retry
+    async def _request() -> Dict[str, Any]:
+        params = {"query": query, "format": _SPARQL_RESULTS_FORMAT}
+        r = await _get_http_client().get(DBPEDIA_SPARQL, params=params, headers=_SPARQL_HEADERS)
+        r.raise_for_status()
+        return r.json()
+
+    async def _fetch() -> Dict[str, Any]:
+        with _sparql_errors():
+            return await _request()
+
+    return await _cached_single_flight(_cache_key(query), _fetch, cache=cache)
+
+
+async def run_sparql_projected(
+    query: str, project: Callable[[Dict[str, Any]], Any]
+) -> List[Any]:
+    # Streams results.bindings with ijson and keeps only project(binding) per row,
+    # so the full SPARQL response is never materialized. Not cached: every caller
+    # is a @_result_cache endpoint whose shaped response is cached instead.
+    # Concurrent identical calls still share one request (keyed by query + projection).
+    @_sparql_retry
+    async def _request() -> List[Any]:
+        params = {"query": query, "format": _SPARQL_RESULTS_FORMAT}
+        async with _get_http_client().stream(
+            "GET", DBPEDIA_SPARQL, params=params, headers=_SPARQL_HEADERS
+        ) as r:
+            r.raise_for_status()
+            reader = _AsyncByteReader(r.aiter_bytes())
+            return [project(b) async for b in ijson.items_async(reader, "results.bindings.item")]
+
+    async def _fetch() -> List[Any]:
+        with _sparql_errors():
+            return await _request()
+
+    h = xxhash.xxh3_128()
+    h.update(b"projected\n")
+    h.update(project.__qualname__.encode("utf-8"))
+    h.update(b"\n")
+    h.update(_cache_key(query).encode("utf-8"))
+    return await _cached_single_flight(h.hexdigest(), _fetch, cache=False)
 
 
-@app.get("/health")
-def health():
-    return {"ok": True}
+# ---------------------------
+# Projection cache: endpoint inputs -> final JSON response
+# ---------------------------
 
-@app.get("/sparql")
-async def sparql(q: str = Query(..., description="SPARQL query string")):
-    return await run_sparql(q)
+def _projection_cache_key(endpoint: str, params: Dict[str, Any]) -> str:
+    h = xxhash.xxh3_128()
+    h.update(b"proj\n")
+    h.update(endpoint.encode("utf-8"))
+    h.update(b"\n")
+    h.update(orjson.dumps(params, option=orjson.OPT_SORT_KEYS))
+    return h.hexdigest()
 
-@app.get("/api/search")
-async def search(
-    q: str = Query(..., min_length=1),
-    kind: str = Query("all", regex="^(all|category|entity)$"),
-    limit: int = Query(20, ge=1, le=100),
-    offset: int = Query(0, ge=0),
-):
-    needle = sparql_escape_str(q)
+def _result_cache(fn):
+    # Caches the shaped endpoint response (same memory+disk layers as run_sparql),
+    # so warm calls skip re-walking bindings and re-encoding ids.
+    @functools.wraps(fn)
+    async def wrapper(**kwargs):
+        key = _projection_cache_key(fn.__name__, kwargs)
+        cached = await cache_get(key)
+        if cached is not None:
+            return cached
+        result = await fn(**kwargs)
+        await cache_set(key, result)
+        return result
+    return wrapper
+
+
+# ---------------------------
+# Cache warming at startup
+# ---------------------------
 
-    # --- ONE count query gives entityTotal + categoryTotal ---
-    counts_q = f"""
+# JSON file holding a list of SPARQL query strings to prefetch
+WARM_QUERIES_FILE = os.getenv("WADE_WARM_QUERIES")
+# Comma-separated search terms whose first /api/search page is prefetched
+WARM_SEARCH_TERMS = [t.strip() for t in os.getenv("WADE_WARM_SEARCH_TERMS", "").split(",") if t.strip()]
+WARM_CONCURRENCY = 4
+
+_warm_task = None  # type: Optional[asyncio.Task]
+
+def _load_warm_queries() -> List[str]:
+    if not WARM_QUERIES_FILE:
+        return []
+    try:
+        queries = orjson.loads(Path(WARM_QUERIES_FILE).read_bytes())
+    except Exception:
+        return []
+    if not isinstance(queries, list):
+        return []
+    return [q for q in queries if isinstance(q, str)]
+
+async def _warm_cache() -> None:
+    sem = asyncio.Semaphore(WARM_CONCURRENCY)
+
+    async def _limited(make_coro):
+        # create the coroutine only once a slot is free, so a cancelled warm-up
+        # doesn't leave never-awaited coroutines behind
+        async with sem:
+            return await make_coro()
+
+    jobs = [functools.partial(run_sparql, q) for q in _load_warm_queries()]
+    jobs += [
+        functools.partial(search, q=term, kind="all", limit=20, offset=0)
+        for term in WARM_SEARCH_TERMS
+    ]
+    # best-effort: a failing query must not affect the others or the server
+    await asyncio.gather(*(_limited(j) for j in jobs), return_exceptions=True)
+
+@app.on_event("startup")
+async def _start_cache_warming() -> None:
+    global _warm_task
+    # run in the background so a slow DBpedia doesn't delay startup
+    _warm_task = asyncio.create_task(_warm_cache())
+
+@app.on_event("shutdown")
+async def _stop_cache_warming() -> None:
+    if _warm_task is not None:
+        _warm_task.cancel()
+        # wait for it to unwind so no job reaches for the HTTP client after it's closed
+        await asyncio.gather(_warm_task, return_exceptions=True)
+
+# registered after every background-task shutdown hook so those run first
+app.on_event("shutdown")(_close_http_client)
+
+
+# ---------------------------
+# SPARQL query templates (str.format placeholders, rendered via _render_query)
+# ---------------------------
+
+_SEARCH_KIND_FILTERS = {
+    "all": "",
+    "entity": f'FILTER(!STRSTARTS(STR(?s), "{DBPEDIA_CATEGORY_PREFIX}"))',
+    "category": f'FILTER(STRSTARTS(STR(?s), "{DBPEDIA_CATEGORY_PREFIX}"))',
+}
+
+_SEARCH_RESULTS_TEMPLATE = """
 PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
-PREFIX xsd:  <http://www.w3.org/2001/XMLSchema#>
 
-SELECT
-  (SUM(?isEnt) AS ?entityTotal)
-  (SUM(?isCat) AS ?categoryTotal)
+SELECT DISTINCT ?s (SAMPLE(?label) AS ?label)
 WHERE {{
   ?s rdfs:label ?label .
   FILTER(lang(?label)="en") .
   FILTER(CONTAINS(LCASE(STR(?label)), LCASE("{needle}"))) .
+  {filter_kind}
+}}
+GROUP BY ?s
+LIMIT {limit}
+OFFSET {offset}
+"""
 
-  BIND(IF(CONTAINS(STR(?s), "Category:"), 1, 0) AS ?isCat)
-  BIND(IF(CONTAINS(STR(?s), "Category:"), 0, 1) AS ?isEnt)
+_SEARCH_COMBINED_TEMPLATE = """
+PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
+
+SELECT ?s ?label ?entityTotal ?categoryTotal
+WHERE {{
+  {{
+    SELECT
+      (SUM(?isEnt) AS ?entityTotal)
+      (SUM(?isCat) AS ?categoryTotal)
+    WHERE {{
+      ?s rdfs:label ?label .
+      FILTER(lang(?label)="en") .
+      FILTER(CONTAINS(LCASE(STR(?label)), LCASE("{needle}"))) .
+
+      BIND(IF(STRSTARTS(STR(?s), "{category_prefix}"), 1, 0) AS ?isCat)
+      BIND(IF(STRSTARTS(STR(?s), "{category_prefix}"), 0, 1) AS ?isEnt)
+    }}
+  }}
+  UNION
+  {{
+    SELECT DISTINCT ?s (SAMPLE(?label) AS ?label)
+    WHERE {{
+      ?s rdfs:label ?label .
+      FILTER(lang(?label)="en") .
+      FILTER(CONTAINS(LCASE(STR(?label)), LCASE("{needle}"))) .
+      {filter_kind}
+    }}
+    GROUP BY ?s
+    LIMIT {limit}
+    OFFSET {offset}
+  }}
 }}
 """
 
-    # --- Results query (paged) ---
-    filter_kind = ""
-    if kind == "entity":
-        filter_kind = 'FILTER(!CONTAINS(STR(?s), "Category:"))'
-    elif kind == "category":
-        filter_kind = 'FILTER(CONTAINS(STR(?s), "Category:"))'
+_CATEGORY_DETAILS_TEMPLATE = """
+PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
+PREFIX skos: <http://www.w3.org/2004/02/skos/core#>
+PREFIX dct:  <http://purl.org/dc/terms/>
+
+SELECT ?label ?broader ?broaderLabel ?narrower ?narrowerLabel
+       (COUNT(DISTINCT ?entity) AS ?entityCount)
+WHERE {{
+  OPTIONAL {{ <{cat_uri}> rdfs:label ?label FILTER(lang(?label)="en") . }}
+  OPTIONAL {{
+    <{cat_uri}> skos:broader ?broader .
+    OPTIONAL {{ ?broader rdfs:label ?broaderLabel FILTER(lang(?broaderLabel)="en") }}
+  }}
+  OPTIONAL {{
+    ?narrower skos:broader <{cat_uri}> .
+    OPTIONAL {{ ?narrower rdfs:label ?narrowerLabel FILTER(lang(?narrowerLabel)="en") }}
+  }}
+  OPTIONAL {{ ?entity dct:subject <{cat_uri}> . }}
+}}
+GROUP BY ?label ?broader ?broaderLabel ?narrower ?narrowerLabel
+LIMIT 500
+"""
 
-    results_q = f"""
+_CATEGORY_ENTITIES_TEMPLATE = """
+PREFIX dct:  <http://purl.org/dc/terms/>
 PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
 
-SELECT DISTINCT ?s (SAMPLE(?label) AS ?label)
+SELECT ?entity (SAMPLE(?label) AS ?label)
 WHERE {{
-  ?s rdfs:label ?label .
-  FILTER(lang(?label)="en") .
-  FILTER(CONTAINS(LCASE(STR(?label)), LCASE("{needle}"))) .
-  {filter_kind}
+  ?entity dct:subject <{cat_uri}> .
+  OPTIONAL {{ ?entity rdfs:label ?label FILTER(lang(?label)="en") }}
 }}
-GROUP BY ?s
+GROUP BY ?entity
+ORDER BY ?entity
+LIMIT {limit}
+OFFSET {offset}
+"""
+
+_ENTITY_DETAILS_TEMPLATE = """
+PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
+PREFIX dbo:  <http://dbpedia.org/ontology/>
+PREFIX dct:  <http://purl.org/dc/terms/>
+
+SELECT ?label ?abstract ?type ?cat ?catLabel
+WHERE {{
+  OPTIONAL {{ <{ent_uri}> rdfs:label ?label FILTER(lang(?label)="en") . }}
+  OPTIONAL {{ <{ent_uri}> dbo:abstract ?abstract FILTER(lang(?abstract)="en") . }}
+  OPTIONAL {{ <{ent_uri}> a ?type . }}
+  OPTIONAL {{
+    <{ent_uri}> dct:subject ?cat .
+    OPTIONAL {{ ?cat rdfs:label ?catLabel FILTER(lang(?catLabel)="en") }}
+  }}
+}}
+LIMIT 500
+"""
+
+_CATEGORY_TYPE_FACETS_TEMPLATE = """
+PREFIX dct: <http://purl.org/dc/terms/>
+PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
+
+SELECT ?type (COUNT(DISTINCT ?e) AS ?count)
+WHERE {{
+  ?e dct:subject <{cat_uri}> .
+  ?e rdf:type ?type .
+}}
+GROUP BY ?type
+ORDER BY DESC(?count)
+LIMIT {limit}
+"""
+
+_CATEGORY_ENTITIES_BY_TYPE_TEMPLATE = """
+PREFIX dct:  <http://purl.org/dc/terms/>
+PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
+
+SELECT ?entity (SAMPLE(?label) AS ?label)
+WHERE {{
+  ?entity dct:subject <{cat_uri}> .
+  {values_block}
+  {type_triple}
+  OPTIONAL {{ ?entity rdfs:label ?label FILTER(lang(?label)="en") }}
+}}
+GROUP BY ?entity
+ORDER BY ?entity
 LIMIT {limit}
 OFFSET {offset}
 """
 
-    # run both in parallel (still only 2 calls)
-    counts_data, data = await asyncio.gather(
-        run_sparql(counts_q),
-        run_sparql(results_q),
+_ENTITY_RELATED_TEMPLATE = """
+PREFIX dct:  <http://purl.org/dc/terms/>
+PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
+
+SELECT ?other (SAMPLE(?label) AS ?label) (COUNT(DISTINCT ?cat) AS ?shared)
+WHERE {{
+  <{entity_uri}> dct:subject ?cat .
+  ?other dct:subject ?cat .
+  FILTER(?other != <{entity_uri}>) .
+  OPTIONAL {{ ?other rdfs:label ?label FILTER(lang(?label)="en") }}
+}}
+GROUP BY ?other
+ORDER BY DESC(?shared)
+LIMIT {limit}
+"""
+
+@functools.lru_cache(maxsize=1024)
+def _render_query(template: str, **params: Any) -> str:
+    # repeated (template, params) combos, e.g. popular pages, skip re-formatting
+    return template.format(**params)
+
+
+# ---------------------------
+# Row projections for run_sparql_projected
+# ---------------------------
+
+def _project_entity_row(b: Dict[str, Any]) -> Dict[str, Any]:
+    uri = b["entity"]["value"]
+    lab = b.get("label")
+    return {
+        "uri": uri,
+        "id": uri_to_id(uri),
+        "label": lab["value"] if lab else uri.rpartition("/")[2],
+    }
+
+def _project_related_row(b: Dict[str, Any]) -> Dict[str, Any]:
+    uri = b["other"]["value"]
+    lab = b.get("label")
+    shared = b.get("shared")
+    return {
+        "uri": uri,
+        "id": uri_to_id(uri),
+        "label": lab["value"] if lab else uri.rpartition("/")[2],
+        "shared": int(shared["value"]) if shared else 0,
+    }
+
+def _project_type_facet(b: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "type": b["type"]["value"],
+        "count": int(b["count"]["value"]),
+    }
+
+
+@app.get("/health")
+def health():
+    return {"ok": True}
+
+@app.get("/sparql")
+async def sparql(q: str = Query(..., description="SPARQL query string")):
+    return await run_sparql(q)
+
+@app.get("/api/search")
+@_result_cache
+async def search(
+    q: str = Query(..., min_length=1),
+    kind: str = Query("all", regex="^(all|category|entity)$"),
+    limit: int = Query(20, ge=1, le=100),
+    offset: int = Query(0, ge=0),
+):
+    needle = sparql_escape_str(q)
+
+    # --- Results query (paged) ---
+    filter_kind = _SEARCH_KIND_FILTERS[kind]
+
+    results_q = _render_query(
+        _SEARCH_RESULTS_TEMPLATE, needle=needle, filter_kind=filter_kind, limit=limit, offset=offset
     )
 
+    # --- Both as subselects of one query (one DBpedia round-trip) ---
+    combined_q = _render_query(
+        _SEARCH_COMBINED_TEMPLATE,
+        needle=needle,
+        filter_kind=filter_kind,
+        limit=limit,
+        offset=offset,
+        category_prefix=DBPEDIA_CATEGORY_PREFIX,
+    )
+
+    # counts depend only on q (not kind/limit/offset), so every page of the same
+    # search shares one entry; if it's cached, only fetch the page. It lives in the
+    # projection namespace so raw SPARQL keys only ever hold real DBpedia responses.
+    counts_key = _projection_cache_key("search_counts", {"q": q})
+    counts_data = await cache_get(counts_key)
+    if counts_data is not None:
+        data = await run_sparql(results_q, cache=False)
+    else:
+        combined = await run_sparql(combined_q, cache=False)
+        # result rows bind ?s; the single aggregate row doesn't
+        count_rows = []
+        page_rows = []
+        for b in combined.get("results", {}).get("bindings", []):
+            (page_rows if "s" in b else count_rows).append(b)
+        counts_data = {"results": {"bindings": count_rows}}
+        data = {"results": {"bindings": page_rows}}
+        # seed the counts entry so later pages of this search take the branch above
+        await cache_set(counts_key, counts_data)
+
     def extract_sum(d, key: str) -> int:
         b = d.get("results", {}).get("bindings", [])
         if not b:
@@ -270,14 +793,13 @@ OFFSET {offset}
     results = []
     for b in bindings:
         uri = b["s"]["value"]
-        label = b.get("label", {}).get("value", uri.split("/")[-1])
-        is_category = "Category:" in uri
+        lab = b.get("label")
         results.append({
-        "uri": uri,
-        "id": uri_to_id(uri),
-        "label": label,
-        "kind": "category" if is_category else "entity",
-    })
+            "uri": uri,
+            "id": uri_to_id(uri),
+            "label": lab["value"] if lab else uri.rpartition("/")[2],
+            "kind": "category" if uri.startswith(DBPEDIA_CATEGORY_PREFIX) else "entity",
+        })
 
 
     return {
@@ -294,32 +816,12 @@ OFFSET {offset}
 
 
 @app.get("/api/category/{id_}")
+@_result_cache
 async def category_details(id_: str):
     cat_uri = id_to_uri(id_)
     cat_uri = cat_uri.replace("https://dbpedia.org/", "http://dbpedia.org/")
-    sparql_query = f"""
-PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
-PREFIX skos: <http://www.w3.org/2004/02/skos/core#>
-PREFIX dct:  <http://purl.org/dc/terms/>
-
-SELECT ?label ?broader ?broaderLabel ?narrower ?narrowerLabel
-       (COUNT(DISTINCT ?entity) AS ?entityCount)
-WHERE {{
-  OPTIONAL {{ <{cat_uri}> rdfs:label ?label FILTER(lang(?label)="en") . }}
-  OPTIONAL {{
-    <{cat_uri}> skos:broader ?broader .
-    OPTIONAL {{ ?broader rdfs:label ?broaderLabel FILTER(lang(?broaderLabel)="en") }}
-  }}
-  OPTIONAL {{
-    ?narrower skos:broader <{cat_uri}> .
-    OPTIONAL {{ ?narrower rdfs:label ?narrowerLabel FILTER(lang(?narrowerLabel)="en") }}
-  }}
-  OPTIONAL {{ ?entity dct:subject <{cat_uri}> . }}
-}}
-GROUP BY ?label ?broader ?broaderLabel ?narrower ?narrowerLabel
-LIMIT 500
-"""
-    data = await run_sparql(sparql_query)
+    sparql_query = _render_query(_CATEGORY_DETAILS_TEMPLATE, cat_uri=cat_uri)
+    data = await run_sparql(sparql_query, cache=False)
     bindings = data.get("results", {}).get("bindings", [])
 
     label = None
@@ -328,29 +830,33 @@ LIMIT 500
     entity_count = 0
 
     for b in bindings:
-        if "label" in b and label is None:
-            label = b["label"]["value"]
+        b_get = b.get
+        if label is None and (lab := b_get("label")):
+            label = lab["value"]
 
-        if "entityCount" in b:
+        if (cnt := b_get("entityCount")):
             try:
-                entity_count = int(b["entityCount"]["value"])
+                entity_count = int(cnt["value"])
             except Exception:
                 pass
 
-        if "broader" in b:
-            uri = b["broader"]["value"]
+        if (br := b_get("broader")) and br["value"] not in broader:
+            # rows repeat URIs (cross-product bindings); first label seen wins
+            uri = br["value"]
+            lab = b_get("broaderLabel")
             broader[uri] = {
                 "uri": uri,
                 "id": uri_to_id(uri),
-                "label": b.get("broaderLabel", {}).get("value", uri.split("/")[-1]),
+                "label": lab["value"] if lab else uri.rpartition("/")[2],
             }
 
-        if "narrower" in b:
-            uri = b["narrower"]["value"]
+        if (nr := b_get("narrower")) and nr["value"] not in narrower:
+            uri = nr["value"]
+            lab = b_get("narrowerLabel")
             narrower[uri] = {
                 "uri": uri,
                 "id": uri_to_id(uri),
-                "label": b.get("narrowerLabel", {}).get("value", uri.split("/")[-1]),
+                "label": lab["value"] if lab else uri.rpartition("/")[2],
             }
 
     return {
@@ -363,34 +869,12 @@ LIMIT 500
     }
 
 @app.get("/api/category/{id_}/entities")
+@_result_cache
 async def category_entities(id_: str, limit: int = Query(50, ge=1, le=100), offset: int = Query(0, ge=0)):
     cat_uri = id_to_uri(id_)
     cat_uri = cat_uri.replace("https://dbpedia.org/", "http://dbpedia.org/")
-    sparql_query = f"""
-PREFIX dct:  <http://purl.org/dc/terms/>
-PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
-
-SELECT ?entity (SAMPLE(?label) AS ?label)
-WHERE {{
-  ?entity dct:subject <{cat_uri}> .
-  OPTIONAL {{ ?entity rdfs:label ?label FILTER(lang(?label)="en") }}
-}}
-GROUP BY ?entity
-ORDER BY ?entity
-LIMIT {limit}
-OFFSET {offset}
-"""
-    data = await run_sparql(sparql_query)
-    bindings = data.get("results", {}).get("bindings", [])
-
-    results = []
-    for b in bindings:
-        uri = b["entity"]["value"]
-        results.append({
-            "uri": uri,
-            "id": uri_to_id(uri),
-            "label": b.get("label", {}).get("value", uri.split("/")[-1]),
-        })
+    sparql_query = _render_query(_CATEGORY_ENTITIES_TEMPLATE, cat_uri=cat_uri, limit=limit, offset=offset)
+    results = await run_sparql_projected(sparql_query, _project_entity_row)
 
     return {
         "categoryUri": cat_uri,
@@ -403,27 +887,12 @@ OFFSET {offset}
 
 
 @app.get("/api/entity/{id_}")
+@_result_cache
 async def entity_details(id_: str):
     ent_uri = id_to_uri(id_)
 
-    sparql_query = f"""
-PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
-PREFIX dbo:  <http://dbpedia.org/ontology/>
-PREFIX dct:  <http://purl.org/dc/terms/>
-
-SELECT ?label ?abstract ?type ?cat ?catLabel
-WHERE {{
-  OPTIONAL {{ <{ent_uri}> rdfs:label ?label FILTER(lang(?label)="en") . }}
-  OPTIONAL {{ <{ent_uri}> dbo:abstract ?abstract FILTER(lang(?abstract)="en") . }}
-  OPTIONAL {{ <{ent_uri}> a ?type . }}
-  OPTIONAL {{
-    <{ent_uri}> dct:subject ?cat .
-    OPTIONAL {{ ?cat rdfs:label ?catLabel FILTER(lang(?catLabel)="en") }}
-  }}
-}}
-LIMIT 500
-"""
-    data = await run_sparql(sparql_query)
+    sparql_query = _render_query(_ENTITY_DETAILS_TEMPLATE, ent_uri=ent_uri)
+    data = await run_sparql(sparql_query, cache=False)
     bindings = data.get("results", {}).get("bindings", [])
 
     label = None
@@ -432,18 +901,21 @@ LIMIT 500
     cats = {}
 
     for b in bindings:
-        if "label" in b and label is None:
-            label = b["label"]["value"]
-        if "abstract" in b and abstract is None:
-            abstract = b["abstract"]["value"]
-        if "type" in b:
-            types.add(b["type"]["value"])
-        if "cat" in b:
-            uri = b["cat"]["value"]
+        b_get = b.get
+        if label is None and (lab := b_get("label")):
+            label = lab["value"]
+        if abstract is None and (ab := b_get("abstract")):
+            abstract = ab["value"]
+        if (t := b_get("type")):
+            types.add(t["value"])
+        if (cat := b_get("cat")) and cat["value"] not in cats:
+            # the type OPTIONAL multiplies rows, so each category repeats per type
+            uri = cat["value"]
+            cl = b_get("catLabel")
             cats[uri] = {
                 "uri": uri,
                 "id": uri_to_id(uri),
-                "label": b.get("catLabel", {}).get("value", uri.split("/")[-1]),
+                "label": cl["value"] if cl else uri.rpartition("/")[2],
             }
 
     return {
@@ -456,31 +928,12 @@ LIMIT 500
     }
 
 @app.get("/api/category/{id_}/facets/types")
+@_result_cache
 async def category_type_facets(id_: str, limit: int = Query(15, ge=1, le=50)):
     cat_uri = id_to_uri(id_)
     cat_uri = cat_uri.replace("https://dbpedia.org/", "http://dbpedia.org/")
-    sparql_query = f"""
-PREFIX dct: <http://purl.org/dc/terms/>
-PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
-
-SELECT ?type (COUNT(DISTINCT ?e) AS ?count)
-WHERE {{
-  ?e dct:subject <{cat_uri}> .
-  ?e rdf:type ?type .
-}}
-GROUP BY ?type
-ORDER BY DESC(?count)
-LIMIT {limit}
-"""
-    data = await run_sparql(sparql_query)
-    bindings = data.get("results", {}).get("bindings", [])
-
-    facets = []
-    for b in bindings:
-        facets.append({
-            "type": b["type"]["value"],
-            "count": int(b["count"]["value"]),
-        })
+    sparql_query = _render_query(_CATEGORY_TYPE_FACETS_TEMPLATE, cat_uri=cat_uri, limit=limit)
+    facets = await run_sparql_projected(sparql_query, _project_type_facet)
 
     return {
         "categoryUri": cat_uri,
@@ -490,6 +943,7 @@ LIMIT {limit}
     }
 
 @app.get("/api/category/{id_}/entitiesByType")
+@_result_cache
 async def category_entities_by_type(
     id_: str,
     types: str = Query("", description="Comma-separated list of type URIs"),
@@ -507,33 +961,15 @@ async def category_entities_by_type(
         values_block = f"VALUES ?t {{ {values} }}"
         type_triple = "?entity a ?t ."
 
-    sparql_query = f"""
-PREFIX dct:  <http://purl.org/dc/terms/>
-PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
-
-SELECT ?entity (SAMPLE(?label) AS ?label)
-WHERE {{
-  ?entity dct:subject <{cat_uri}> .
-  {values_block}
-  {type_triple}
-  OPTIONAL {{ ?entity rdfs:label ?label FILTER(lang(?label)="en") }}
-}}
-GROUP BY ?entity
-ORDER BY ?entity
-LIMIT {limit}
-OFFSET {offset}
-"""
-    data = await run_sparql(sparql_query)
-    bindings = data.get("results", {}).get("bindings", [])
-
-    results = []
-    for b in bindings:
-        uri = b["entity"]["value"]
-        results.append({
-            "uri": uri,
-            "id": uri_to_id(uri),
-            "label": b.get("label", {}).get("value", uri.split("/")[-1]),
-        })
+    sparql_query = _render_query(
+        _CATEGORY_ENTITIES_BY_TYPE_TEMPLATE,
+        cat_uri=cat_uri,
+        values_block=values_block,
+        type_triple=type_triple,
+        limit=limit,
+        offset=offset,
+    )
+    results = await run_sparql_projected(sparql_query, _project_entity_row)
 
     return {
         "categoryUri": cat_uri,
@@ -546,37 +982,13 @@ OFFSET {offset}
     }
 
 @app.get("/api/entity/{id_}/related")
+@_result_cache
 async def entity_related(id_: str, limit: int = Query(10, ge=1, le=50)):
     entity_uri = id_to_uri(id_)
     entity_uri = entity_uri.replace("https://dbpedia.org/", "http://dbpedia.org/")
 
-    sparql_query = f"""
-PREFIX dct:  <http://purl.org/dc/terms/>
-PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
-
-SELECT ?other (SAMPLE(?label) AS ?label) (COUNT(DISTINCT ?cat) AS ?shared)
-WHERE {{
-  <{entity_uri}> dct:subject ?cat .
-  ?other dct:subject ?cat .
-  FILTER(?other != <{entity_uri}>) .
-  OPTIONAL {{ ?other rdfs:label ?label FILTER(lang(?label)="en") }}
-}}
-GROUP BY ?other
-ORDER BY DESC(?shared)
-LIMIT {limit}
-"""
-    data = await run_sparql(sparql_query)
-    bindings = data.get("results", {}).get("bindings", [])
-
-    results = []
-    for b in bindings:
-        uri = b["other"]["value"]
-        results.append({
-            "uri": uri,
-            "id": uri_to_id(uri),
-            "label": b.get("label", {}).get("value", uri.split("/")[-1]),
-            "shared": int(b.get("shared", {}).get("value", "0")),
-        })
+    sparql_query = _render_query(_ENTITY_RELATED_TEMPLATE, entity_uri=entity_uri, limit=limit)
+    results = await run_sparql_projected(sparql_query, _project_related_row)
 
     return {
         "entityUri": entity_uri,